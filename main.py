@@ -1,21 +1,40 @@
+import atexit
 import email
+import hashlib
 import html
 import imaplib
 import json
 import logging
 import os
 import pathlib
+import queue
 import re
+import select
+import signal
 import socket
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from email.errors import HeaderParseError
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
 from logging.handlers import TimedRotatingFileHandler
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from charset_normalizer import from_bytes as charset_from_bytes
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # --- SETUP PATHS & ENV ---
 script_dir = pathlib.Path(__file__).parent.absolute()
@@ -23,6 +42,9 @@ env_path = script_dir / ".env"
 load_dotenv(env_path)
 
 PROCESSED_FILE = script_dir / "processed_emails.json"
+PROCESSED_LOG = script_dir / "processed_emails.log"
+PROCESSED_DB = script_dir / "processed_emails.db"
+MAILBOX_STATE_FILE = script_dir / "mailbox_state.json"
 PROCESSED_RETENTION_DAYS = int(os.getenv("PROCESSED_RETENTION_DAYS", "14"))
 
 # --- CONFIG ---
@@ -30,8 +52,15 @@ IMAP_SERVER = os.getenv("IMAP_SERVER", "")
 IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
 IMAP_TIMEOUT = int(os.getenv("IMAP_TIMEOUT", "30"))
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "3600")) 
+IMAP_IDLE = os.getenv("IMAP_IDLE", "").strip().lower() in ("1", "true", "yes")
+IDLE_REFRESH = 29 * 60  # servers may drop IDLE after 30 minutes
+IDLE_RETRY_DELAY = 30
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "800"))
+MAX_WORKERS = 8
+FETCH_BATCH_SIZE = 50
+# Untagged non-UTF-8 mail is almost always Russian or Western; short texts misdetect without this hint
+SNIFF_CHARSETS = ["cp1251", "koi8_r", "cp1252"]
 
 EMAILS = [x.strip() for x in os.getenv("EMAILS", "").split(",") if x.strip()]
 PASSWORDS = [x.strip() for x in os.getenv("PASSWORDS", "").split(",") if x.strip()]
@@ -55,41 +84,143 @@ GLOBAL_ALERT_PHRASES = [
     "invoice overdue", "subscription expired", "credit card was declined"
 ]
 
+# Text cleanup patterns, compiled once
+_RE_NON_TEXT = re.compile(r"<(style|script|title)[^>]*>.*?</\1>", re.DOTALL | re.IGNORECASE)
+_RE_XML_DECL = re.compile(r"^\ufeff?\s*<\?xml[^>]*\?>")
+_RE_TAG = re.compile(r"<[^>]+>")
+_RE_MULTI_NL = re.compile(r"\n{3,}")
+_RE_FETCH_UID = re.compile(rb"\bUID (\d+)")
+
+# Header-only parser for the sender/duplicate checks before the body is fetched
+_HEADER_PARSER = BytesHeaderParser()
+
+# Compiled keyword matchers, keyed by the company's extra keywords
+_KEYWORD_MATCHERS: dict = {}
+
 # --- LOGGING ---
 log_file = script_dir / "payment_bot.log"
-handler = TimedRotatingFileHandler(log_file, when="midnight", interval=1, backupCount=7, encoding="utf-8")
-handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
 logger = logging.getLogger("payment_monitor")
 logger.setLevel(logging.INFO)
-logger.addHandler(handler)
-logger.addHandler(logging.StreamHandler())
+# The logger is process-wide: loading this file twice (as __main__ and as
+# "main") must not attach a second set of handlers and double every line
+if not logger.handlers:
+    handler = TimedRotatingFileHandler(log_file, when="midnight", interval=1, backupCount=7, encoding="utf-8", delay=True)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    logger.addHandler(logging.StreamHandler())
+
+# --- TELEGRAM SESSION ---
+# Keep-alive connection pool so alert bursts reuse one TLS connection.
+# sendMessage isn't idempotent: only failures where Telegram surely didn't deliver
+# are retried (connect errors, 429/503 with Retry-After), never read timeouts.
+_TG_RETRY = Retry(
+    total=3, read=0, backoff_factor=1, status_forcelist=[429, 503],
+    allowed_methods=frozenset({"POST"}), raise_on_status=False
+)
+_TG_SESSION = requests.Session()
+_TG_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=_TG_RETRY))
+
+class RateLimiter:
+    """ Token bucket allowing `rate` calls per `per` seconds; acquire() blocks until a token is free """
+    def __init__(self, rate: int, per: float):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.per = per
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.capacity / self.per)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) * self.per / self.capacity)
+
+# Telegram limits: ~30 messages/s per bot, ~1 message/s per chat
+_TG_GLOBAL_LIMIT = RateLimiter(30, 1.0)
+_TG_CHAT_LIMITS: dict[str, RateLimiter] = {}
+_TG_CHAT_LIMITS_LOCK = threading.Lock()
+
+def chat_rate_limiter(chat_id: str) -> RateLimiter:
+    with _TG_CHAT_LIMITS_LOCK:
+        if chat_id not in _TG_CHAT_LIMITS:
+            _TG_CHAT_LIMITS[chat_id] = RateLimiter(1, 1.0)
+        return _TG_CHAT_LIMITS[chat_id]
+
+# Alerts are handed to one sender thread so mailbox checks never wait on
+# Telegram pacing, retries or network latency
+_TG_QUEUE: queue.Queue = queue.Queue()
+_TG_SENDER = None
+_TG_SENDER_LOCK = threading.Lock()
 
 # --- HELPERS ---
+def parse_start_date() -> str | None:
+    """ START_DATE (YYYY-MM-DD) as an IMAP date, or None when unset/invalid """
+    if not START_DATE_ENV: return None
+    try:
+        return datetime.strptime(START_DATE_ENV, "%Y-%m-%d").strftime("%d-%b-%Y")
+    except ValueError:
+        logger.warning(f"Invalid START_DATE format: {START_DATE_ENV}. Use YYYY-MM-DD. Falling back to 24h.")
+        return None
+
+# START_DATE is read once from env, so parse it once too
+_START_DATE_FIXED = parse_start_date()
+
 def resolve_since_date() -> str:
     """ Formats date for IMAP: DD-Mon-YYYY """
-    if START_DATE_ENV:
-        try:
-            dt = datetime.strptime(START_DATE_ENV, "%Y-%m-%d")
-            return dt.strftime("%d-%b-%Y")
-        except ValueError:
-            logger.warning(f"Invalid START_DATE format: {START_DATE_ENV}. Use YYYY-MM-DD. Falling back to 24h.")
-    return (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
+    return _START_DATE_FIXED or (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
 
 def clean_html_content(raw_html: str) -> str:
+    if not raw_html.strip(): return ""
+    # lxml refuses str input that carries an encoding declaration (common in XHTML mail)
+    raw_html = _RE_XML_DECL.sub("", raw_html, count=1)
     try:
-        soup = BeautifulSoup(raw_html, "lxml")
-        for element in soup(["script", "style", "head", "title", "meta", "[document]"]):
-            element.decompose()
-        text = soup.get_text(separator=' ')
-        text = html.unescape(text)
+        doc = lxml_html.fromstring(raw_html)
+        etree.strip_elements(doc, etree.Comment, "script", "style", "head", "title", "meta", with_tail=False)
+        text = " ".join(doc.itertext())
         lines = [line.strip() for line in text.splitlines() if line.strip()]
         return "\n".join(lines)
     except Exception as e:
-        logger.warning(f"BS4 failed, using regex fallback: {e}")
-        text = re.sub(r"<(style|script)[^>]*>.*?</\1>", " ", raw_html, flags=re.DOTALL | re.IGNORECASE)
-        text = re.sub(r"<[^>]+>", " ", text)
+        logger.warning(f"HTML parse failed, using regex fallback: {e}")
+        text = _RE_NON_TEXT.sub(" ", raw_html)
+        text = html.unescape(_RE_TAG.sub(" ", text))
         return " ".join(text.split())
 
+def build_keyword_matcher(keywords: list):
+    """ Compiles all phrases into one automaton (or one regex) so each text is scanned once """
+    phrases = sorted({k.lower() for k in keywords if k}, key=len, reverse=True)
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for phrase in phrases:
+            automaton.add_word(phrase, phrase)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text), None) is not None
+    pattern = re.compile("|".join(map(re.escape, phrases)))
+    return lambda text: pattern.search(text) is not None
+
+def get_keyword_matcher(extra_keywords: list):
+    key = frozenset(extra_keywords)
+    if key not in _KEYWORD_MATCHERS:
+        _KEYWORD_MATCHERS[key] = build_keyword_matcher(GLOBAL_ALERT_PHRASES + list(key))
+    return _KEYWORD_MATCHERS[key]
+
+def decode_payload(payload: bytes, charset: str | None) -> str:
+    """ Decodes with the declared charset; undeclared or unknown ones are sniffed only if UTF-8 fails """
+    if charset:
+        try:
+            return payload.decode(charset, errors="replace")
+        except LookupError:
+            pass
+    try:
+        return payload.decode("utf-8")
+    except UnicodeDecodeError:
+        best = charset_from_bytes(payload, cp_isolation=SNIFF_CHARSETS).best()
+        return str(best) if best is not None else payload.decode("utf-8", errors="replace")
+
 def extract_clean_text(msg) -> str:
     text_parts = []
     if msg.is_multipart():
@@ -101,111 +232,441 @@ def extract_clean_text(msg) -> str:
             if ctype == "text/plain":
                 payload = part.get_payload(decode=True)
                 if payload:
-                    text_parts.append(payload.decode(part.get_content_charset() or "utf-8", errors="replace"))
+                    text_parts.append(decode_payload(payload, part.get_content_charset()))
             elif ctype == "text/html" and not text_parts:
                 payload = part.get_payload(decode=True)
                 if payload:
-                    text_parts.append(clean_html_content(payload.decode(part.get_content_charset() or "utf-8", errors="replace")))
+                    text_parts.append(clean_html_content(decode_payload(payload, part.get_content_charset())))
     else:
         payload = msg.get_payload(decode=True)
         if payload:
-            content = payload.decode(msg.get_content_charset() or "utf-8", errors="replace")
+            content = decode_payload(payload, msg.get_content_charset())
             if msg.get_content_type() == "text/html":
                 content = clean_html_content(content)
             text_parts.append(content)
 
     full_text = "\n".join(text_parts).strip()
-    full_text = re.sub(r'\n{3,}', '\n\n', full_text)
+    full_text = _RE_MULTI_NL.sub("\n\n", full_text)
     if len(full_text) > MAX_BODY_CHARS:
         full_text = full_text[:MAX_BODY_CHARS].rstrip() + "..."
     return full_text or "(empty body)"
 
 def decode_header_value(value: str) -> str:
     if not value: return ""
+    value = str(value)
+    # No RFC 2047 encoded-word, nothing to decode
+    if "=?" not in value: return value
+    try:
+        parts = decode_header(value)
+    except HeaderParseError:
+        return value
     decoded = []
-    for val, enc in decode_header(value):
+    for val, enc in parts:
         if isinstance(val, bytes):
-            decoded.append(val.decode(enc or "utf-8", errors="replace"))
+            try:
+                decoded.append(val.decode(enc or "utf-8", errors="replace"))
+            except LookupError:
+                # Unknown charsets like unknown-8bit or x-foo
+                decoded.append(val.decode("utf-8", errors="replace"))
         else:
             decoded.append(str(val))
     return "".join(decoded)
 
+# --- IMAP POOL ---
+# One logged-in client per mailbox, kept open across polling cycles
+_IMAP_POOL: dict[str, imaplib.IMAP4_SSL] = {}
+
+def drop_imap(email_addr: str):
+    mail = _IMAP_POOL.pop(email_addr, None)
+    if mail is None: return
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+def get_imap(email_addr: str, password: str) -> imaplib.IMAP4_SSL:
+    """ Returns the pooled client for the mailbox, reconnecting if it went stale """
+    mail = _IMAP_POOL.get(email_addr)
+    if mail is not None:
+        try:
+            mail.noop()
+            return mail
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.info(f"IMAP connection for {email_addr} is stale ({e}), reconnecting...")
+            drop_imap(email_addr)
+
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT, timeout=IMAP_TIMEOUT)
+    mail.login(email_addr, password)
+    _IMAP_POOL[email_addr] = mail
+    return mail
+
+def _imap_has_buffered_data(mail: imaplib.IMAP4_SSL) -> bool:
+    """ True if a response line is already readable without waiting on the socket """
+    mail.sock.setblocking(False)
+    try:
+        # peek() returns buffered bytes or does one non-blocking read; nothing is consumed
+        return bool(mail.file.peek(1))
+    except OSError:
+        return False
+    finally:
+        mail.sock.settimeout(IMAP_TIMEOUT)
+
+def idle_wait(mail: imaplib.IMAP4_SSL, timeout: float) -> bool:
+    """ Blocks in IMAP IDLE until the server announces new mail or `timeout` passes """
+    # New mail announced during the last check isn't repeated once IDLE starts
+    pending = [mail.untagged_responses.pop(name, None) for name in ("EXISTS", "RECENT")]
+    if any(pending): return True
+
+    # imaplib (before 3.14) has no IDLE command, so this drives the protocol by hand
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    if not mail._get_line().startswith(b"+"):
+        raise imaplib.IMAP4.error("server refused IDLE")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        if not _imap_has_buffered_data(mail):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable: break
+        line = mail._get_line()
+        if line.endswith((b"EXISTS", b"RECENT")): new_mail = True
+
+    mail.send(b"DONE\r\n")
+    while not mail._get_line().startswith(tag): pass
+    mail.tagged_commands.pop(tag, None)
+    return new_mail
+
+@atexit.register
+def close_imap_pool():
+    for email_addr in list(_IMAP_POOL):
+        drop_imap(email_addr)
+
 # --- TRACKING ---
-def load_processed_ids() -> dict:
-    if not PROCESSED_FILE.exists(): return {}
+# Processed IDs and per-mailbox UID state are kept in SQLite: lookups and
+# pruning are index operations, nothing is parsed or rewritten per cycle.
+# Message-IDs are stored as 64-bit hashes with epoch-second timestamps.
+_DB = None
+_DB_LOCK = threading.Lock()
+
+def get_db() -> sqlite3.Connection:
+    """ Shared connection; callers hold _DB_LOCK while using it """
+    global _DB
+    if _DB is None:
+        db = sqlite3.connect(PROCESSED_DB, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            # Schema setup and migrations apply atomically
+            db.execute("BEGIN")
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if 1 <= version < 3:
+                # v1/v2 stored full Message-ID strings and ISO timestamps
+                db.execute("DROP INDEX IF EXISTS processed_ts")
+                db.execute("ALTER TABLE processed RENAME TO processed_text")
+            db.execute("CREATE TABLE IF NOT EXISTS processed (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS processed_ts ON processed (ts)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS mailbox_state "
+                "(email TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL)"
+            )
+            if version < 1:
+                import_legacy_processed(db)
+            if version < 2:
+                import_legacy_mailbox_state(db)
+            if 1 <= version < 3:
+                insert_processed_rows(db, db.execute("SELECT id, ts FROM processed_text").fetchall())
+                db.execute("DROP TABLE processed_text")
+            db.execute("PRAGMA user_version = 3")
+            db.commit()
+        except Exception:
+            # Nothing half-migrated is kept around; the next call starts over
+            db.rollback()
+            db.close()
+            raise
+        _DB = db
+    return _DB
+
+def msg_key(msg_id: str) -> int:
+    """ Message-ID as a signed 64-bit blake2b hash (SQLite INTEGER range) """
+    return int.from_bytes(hashlib.blake2b(msg_id.encode("utf-8", "replace"), digest_size=8).digest(), "big", signed=True)
+
+def insert_processed_rows(db: sqlite3.Connection, rows):
+    """ Stores (msg_id, iso_ts) pairs from the older stores; later rows win """
+    converted = []
+    for msg_id, ts in rows:
+        try:
+            converted.append((msg_key(msg_id), int(datetime.fromisoformat(ts).timestamp())))
+        except (TypeError, ValueError):
+            continue
+    db.executemany("INSERT OR REPLACE INTO processed (id, ts) VALUES (?, ?)", converted)
+
+def import_legacy_processed(db: sqlite3.Connection):
+    """ One-time import of the old processed_emails.log / processed_emails.json stores """
     try:
-        with open(PROCESSED_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            cutoff = (datetime.now() - timedelta(days=PROCESSED_RETENTION_DAYS)).isoformat()
-            return {k: v for k, v in data.items() if v > cutoff}
-    except: return {}
+        if PROCESSED_LOG.exists():
+            with open(PROCESSED_LOG, "r", encoding="utf-8") as f:
+                rows = [line.rstrip("\n").rsplit("\t", 1) for line in f if "\t" in line]
+        elif PROCESSED_FILE.exists():
+            with open(PROCESSED_FILE, "r", encoding="utf-8") as f:
+                rows = list(json.load(f).items())
+        else:
+            return
+    except Exception as e:
+        logger.warning(f"Could not import old processed IDs: {e}")
+        return
+    # Rows are in write order, so later timestamps win
+    insert_processed_rows(db, rows)
 
-def save_processed_ids(data: dict):
-    with open(PROCESSED_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
+def prune_processed():
+    cutoff = int(time.time()) - PROCESSED_RETENTION_DAYS * 86400
+    try:
+        with _DB_LOCK:
+            db = get_db()
+            db.execute("DELETE FROM processed WHERE ts < ?", (cutoff,))
+            db.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Pruning processed IDs failed: {e}")
 
-# --- CORE LOGIC ---
-def check_mail():
-    processed = load_processed_ids()
-    since_date = resolve_since_date()
-    
-    # Rebuild configs to ensure we use current env
+def is_processed(msg_id: str) -> bool:
+    with _DB_LOCK:
+        return get_db().execute("SELECT 1 FROM processed WHERE id = ? LIMIT 1", (msg_key(msg_id),)).fetchone() is not None
+
+def mark_processed(msg_id: str):
+    """ Staged in the open transaction; commit_processed() persists it """
+    with _DB_LOCK:
+        get_db().execute("INSERT OR REPLACE INTO processed (id, ts) VALUES (?, ?)", (msg_key(msg_id), int(time.time())))
+
+def commit_processed():
+    with _DB_LOCK:
+        get_db().commit()
+
+def import_legacy_mailbox_state(db: sqlite3.Connection):
+    """ One-time import of the old mailbox_state.json """
+    if not MAILBOX_STATE_FILE.exists(): return
+    try:
+        with open(MAILBOX_STATE_FILE, "r", encoding="utf-8") as f:
+            rows = [(k, v["uidvalidity"], v["last_uid"]) for k, v in json.load(f).items()]
+    except Exception as e:
+        logger.warning(f"Could not import old mailbox state: {e}")
+        return
+    db.executemany("INSERT OR REPLACE INTO mailbox_state (email, uidvalidity, last_uid) VALUES (?, ?, ?)", rows)
+
+def get_mailbox_state(email_addr: str) -> dict:
+    """ UIDVALIDITY and highest UID already scanned for the mailbox """
+    with _DB_LOCK:
+        row = get_db().execute(
+            "SELECT uidvalidity, last_uid FROM mailbox_state WHERE email = ?", (email_addr,)
+        ).fetchone()
+    return {"uidvalidity": row[0], "last_uid": row[1]} if row else {}
+
+def set_mailbox_state(email_addr: str, uidvalidity: int, last_uid: int):
+    with _DB_LOCK:
+        db = get_db()
+        db.execute(
+            "INSERT OR REPLACE INTO mailbox_state (email, uidvalidity, last_uid) VALUES (?, ?, ?)",
+            (email_addr, uidvalidity, last_uid)
+        )
+        db.commit()
+
+def build_sender_criteria(senders: list) -> list:
+    """ IMAP SEARCH terms matching any of the senders: OR FROM "a" OR FROM "b" FROM "c" """
+    # imaplib sends search arguments as ASCII; non-ASCII senders (e.g. .рф) are filtered locally
+    if not senders or not all(s.isascii() for s in senders): return []
+    quoted = ['"' + s.replace("\\", "").replace('"', "") + '"' for s in senders]
+    criteria = []
+    for q in quoted[:-1]:
+        criteria += ["OR", "FROM", q]
+    return criteria + ["FROM", quoted[-1]]
+
+def search_new_uids(mail, box_state: dict, uidvalidity: int, since_date: str, senders: list) -> list:
+    """ Returns UIDs above the last scanned one, or everything SINCE on first run / UIDVALIDITY change """
+    last_uid = box_state.get("last_uid", 0) if box_state.get("uidvalidity") == uidvalidity else 0
+    base = ["UID", f"{last_uid + 1}:*"] if last_uid else ["SINCE", since_date]
+
+    status, messages = "NO", [None]
+    sender_criteria = build_sender_criteria(senders)
+    if sender_criteria:
+        try:
+            status, messages = mail.uid("SEARCH", None, *base, *sender_criteria)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"Server rejected FROM search ({e}), filtering senders locally")
+    if status != "OK":
+        status, messages = mail.uid("SEARCH", None, *base)
+
+    if status != "OK" or not messages[0]: return []
+    # "n:*" always matches the highest UID, even when it is below n
+    return [uid for uid in messages[0].split() if int(uid) > last_uid]
+
+def fetch_parts(mail, uids: list, item: str) -> dict:
+    """ One UID FETCH for the whole batch; returns {uid: literal bytes}, raises if any UID is missing """
+    if not uids: return {}
+    status, data = mail.uid("FETCH", b",".join(uids), f"({item})")
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {status} {data}")
+
+    parts, pending = {}, None
+    for entry in data:
+        if isinstance(entry, tuple):
+            m = _RE_FETCH_UID.search(entry[0])
+            if m: parts[m.group(1)] = entry[1]
+            else: pending = entry[1]
+        elif pending is not None and isinstance(entry, bytes):
+            # Some servers send the UID item after the literal
+            m = _RE_FETCH_UID.search(entry)
+            if m: parts[m.group(1)] = pending
+            pending = None
+
+    missing = [uid.decode() for uid in uids if uid not in parts]
+    if missing:
+        raise imaplib.IMAP4.error(f"UID FETCH returned no data for UIDs {','.join(missing)}")
+    return parts
+
+# --- COMPANIES ---
+def build_company_configs() -> list:
+    """ Parses the per-company env lists once; entries with broken config are skipped """
+    companies = []
     for i, email_addr in enumerate(EMAILS):
         try:
-            # Build current company config
             dest = {"chat_id": _raw_chat_ids[i], "topic_id": None}
             if ":" in dest["chat_id"]:
                 cid, tid = dest["chat_id"].split(":", 1)
                 dest = {"chat_id": cid.strip(), "topic_id": int(tid.strip())}
-            
-            tags = [f"@{u}" for u in _raw_tags[i].split("+") if u.strip()] if i < len(_raw_tags) else []
-            senders = [s.lower() for s in _raw_allowed_senders[i].split("+") if s.strip()] if i < len(_raw_allowed_senders) else []
+
             extra_k = [k.lower() for k in _raw_company_keywords[i].split("+") if k.strip()] if i < len(_raw_company_keywords) else []
-            keywords = list(set(GLOBAL_ALERT_PHRASES + extra_k))
-            
-            company_name = COMPANY_NAMES[i] if i < len(COMPANY_NAMES) else email_addr
-            password = PASSWORDS[i]
+            companies.append({
+                "email": email_addr,
+                "password": PASSWORDS[i],
+                "name": COMPANY_NAMES[i] if i < len(COMPANY_NAMES) else email_addr,
+                "dest": dest,
+                "tags": [f"@{u}" for u in _raw_tags[i].split("+") if u.strip()] if i < len(_raw_tags) else [],
+                "senders": [s.lower() for s in _raw_allowed_senders[i].split("+") if s.strip()] if i < len(_raw_allowed_senders) else [],
+                "matches_keyword": get_keyword_matcher(extra_k),
+            })
+        except Exception as e:
+            logger.error(f"Invalid config for {email_addr}, skipping: {e}")
+    return companies
 
-            logger.info(f"Checking {company_name} ({email_addr})...")
-            
-            mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            mail.login(email_addr, password)
-            mail.select("INBOX", readonly=True)
+COMPANIES = build_company_configs()
 
-            # FIX: Use tuple arguments for SEARCH to avoid syntax errors
-            status, messages = mail.search(None, 'SINCE', since_date)
-            
-            if status == "OK" and messages[0]:
-                for num in messages[0].split():
-                    status, data = mail.fetch(num, "(RFC822)")
-                    if status != "OK": continue
-
-                    msg = email.message_from_bytes(data[0][1])
-                    msg_id = msg.get("Message-ID", f"{email_addr}-{num.decode()}")
-                    if msg_id in processed: continue
-
-                    subject = decode_header_value(msg.get("Subject"))
-                    from_raw = decode_header_value(msg.get("From"))
-                    _, sender_email = parseaddr(from_raw.lower())
-
-                    if senders and not any(s in sender_email for s in senders):
-                        processed[msg_id] = datetime.now().isoformat()
-                        continue
-
-                    body = extract_clean_text(msg)
-                    haystack = f"{subject} {body}".lower()
-                    
-                    if any(k.lower() in haystack for k in keywords):
-                        send_alert(company_name, from_raw, subject, body, dest, tags)
-                    
-                    processed[msg_id] = datetime.now().isoformat()
-
-            mail.logout()
-            save_processed_ids(processed)
-            time.sleep(1)
+# --- CORE LOGIC ---
+def check_mail():
+    prune_processed()
+    since_date = resolve_since_date()
+    if not COMPANIES: return
 
-        except Exception as e:
-            logger.error(f"Error checking {email_addr}: {e}")
+    # Mailboxes are I/O bound, so polling them in threads overlaps the network waits
+    with ThreadPoolExecutor(max_workers=min(len(COMPANIES), MAX_WORKERS)) as pool:
+        list(pool.map(lambda company: check_company(company, since_date), COMPANIES))
+
+def check_company(company: dict, since_date: str):
+    email_addr = company["email"]
+    senders = company["senders"]
+    try:
+        logger.info(f"Checking {company['name']} ({email_addr})...")
+
+        mail = get_imap(email_addr, company["password"])
+        mail.select("INBOX", readonly=True)
+        # SELECT's counts describe what this scan covers; later ones mean mail arrived meanwhile
+        mail.untagged_responses.pop("EXISTS", None)
+        mail.untagged_responses.pop("RECENT", None)
+        _, uv = mail.response("UIDVALIDITY")
+        uidvalidity = int(uv[0]) if uv and uv[0] else 0
+
+        uids = search_new_uids(mail, get_mailbox_state(email_addr), uidvalidity, since_date, senders)
+        uids.sort(key=int)
+        for start in range(0, len(uids), FETCH_BATCH_SIZE):
+            batch = uids[start:start + FETCH_BATCH_SIZE]
+            process_uid_batch(mail, company, batch)
+            # Only advance past batches that were fully handled; a failure leaves the rest for next cycle
+            set_mailbox_state(email_addr, uidvalidity, int(batch[-1]))
+
+    except (imaplib.IMAP4.error, OSError) as e:
+        # Any IMAP-level failure leaves the session state unknown; start fresh next cycle
+        drop_imap(email_addr)
+        logger.error(f"IMAP error for {email_addr}: {e}")
+    except Exception as e:
+        logger.error(f"Error checking {email_addr}: {e}")
+
+def watch_company(company: dict):
+    """ IDLE loop for one mailbox: check it, then sleep in IDLE until the server reports new mail """
+    email_addr = company["email"]
+    while True:
+        check_company(company, resolve_since_date())
+        mail = _IMAP_POOL.get(email_addr)
+        if mail is None or "IDLE" not in mail.capabilities:
+            time.sleep(CHECK_INTERVAL)
+            continue
+        try:
+            # Re-check at least every CHECK_INTERVAL even without push events
+            if idle_wait(mail, min(CHECK_INTERVAL, IDLE_REFRESH)):
+                logger.info(f"New mail for {company['name']} ({email_addr})")
+        except (imaplib.IMAP4.error, OSError) as e:
+            drop_imap(email_addr)
+            logger.error(f"IDLE failed for {email_addr}: {e}")
+            time.sleep(IDLE_RETRY_DELAY)
+
+def run_idle():
+    for company in COMPANIES:
+        threading.Thread(target=watch_company, args=(company,), name=f"idle-{company['email']}", daemon=True).start()
+    while True:
+        prune_processed()
+        time.sleep(CHECK_INTERVAL)
+
+def process_uid_batch(mail, company: dict, uids: list):
+    email_addr, senders = company["email"], company["senders"]
+    try:
+        # Headers first; full messages are only downloaded for unseen, allowed senders
+        header_parts = fetch_parts(mail, uids, "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID DATE)]")
+        candidates, seen = [], set()
+        for uid in uids:
+            headers = _HEADER_PARSER.parsebytes(header_parts[uid])
+            msg_id = " ".join(str(headers.get("Message-ID", "")).split()) or f"{email_addr}-{uid.decode()}"
+            # Marks are only staged, so duplicates within one batch are caught here
+            if msg_id in seen or is_processed(msg_id): continue
+            seen.add(msg_id)
+
+            try:
+                subject = decode_header_value(headers.get("Subject"))
+                from_raw = decode_header_value(headers.get("From"))
+                _, sender_email = parseaddr(from_raw.lower())
+            except Exception as e:
+                skip_message(email_addr, uid, msg_id, e)
+                continue
+
+            if senders and not any(s in sender_email for s in senders):
+                mark_processed(msg_id)
+                continue
+            candidates.append((uid, msg_id, subject, from_raw))
+
+        bodies = fetch_parts(mail, [c[0] for c in candidates], "BODY.PEEK[]")
+        for uid, msg_id, subject, from_raw in candidates:
+            try:
+                msg = email.message_from_bytes(bodies[uid])
+
+                body = extract_clean_text(msg)
+
+                # A subject hit settles it; the body is only scanned when the subject is silent
+                matches_keyword = company["matches_keyword"]
+                if matches_keyword(subject.lower()) or matches_keyword(body.lower()):
+                    send_alert(company["name"], from_raw, subject, body, company["dest"], company["tags"])
+            except Exception as e:
+                skip_message(email_addr, uid, msg_id, e)
+                continue
+
+            mark_processed(msg_id)
+    finally:
+        # One commit per batch instead of one per message
+        commit_processed()
+
+def skip_message(email_addr: str, uid: bytes, msg_id: str, error: Exception):
+    """ A message that can't be parsed is logged and marked, so it can't hold back the mailbox checkpoint """
+    logger.error(f"Skipping UID {uid.decode()} ({msg_id}) in {email_addr}: {error}")
+    mark_processed(msg_id)
 
 def send_alert(name, sender, subject, body, dest, tags):
     tag_line = " ".join(tags)
@@ -228,16 +689,53 @@ def send_alert(name, sender, subject, body, dest, tags):
     }
     if dest["topic_id"]: payload["message_thread_id"] = dest["topic_id"]
 
+    enqueue_alert(name, payload)
+
+def enqueue_alert(name: str, payload: dict):
+    global _TG_SENDER
+    with _TG_SENDER_LOCK:
+        if _TG_SENDER is None:
+            _TG_SENDER = threading.Thread(target=telegram_sender, name="telegram-sender", daemon=True)
+            _TG_SENDER.start()
+    _TG_QUEUE.put((name, payload))
+
+def telegram_sender():
+    while True:
+        name, payload = _TG_QUEUE.get()
+        try:
+            deliver_alert(name, payload)
+        finally:
+            _TG_QUEUE.task_done()
+
+def deliver_alert(name: str, payload: dict):
+    chat_rate_limiter(payload["chat_id"]).acquire()
+    _TG_GLOBAL_LIMIT.acquire()
     try:
-        r = requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", json=payload, timeout=15)
+        r = _TG_SESSION.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", json=payload, timeout=15)
         r.raise_for_status()
         logger.info(f"Alert sent for {name}")
     except Exception as e:
         logger.error(f"Telegram failed: {e}")
 
+@atexit.register
+def flush_alerts():
+    """ Lets queued alerts go out before the process exits """
+    if _TG_SENDER is not None:
+        _TG_QUEUE.join()
+
+def handle_sigterm(signum, frame):
+    """ docker/systemd stop sends SIGTERM; exiting via SystemExit runs the atexit flush """
+    logger.info("SIGTERM received, sending queued alerts before exit")
+    raise SystemExit(0)
+
 if __name__ == "__main__":
-    logger.info(f"Bot started. Polling interval: {CHECK_INTERVAL}s")
-    while True:
-        check_mail()
-        logger.info("Cycle complete. Waiting...")
-        time.sleep(CHECK_INTERVAL)
\ No newline at end of file
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if IMAP_IDLE:
+        logger.info(f"Bot started in IDLE mode. Fallback check interval: {CHECK_INTERVAL}s")
+        run_idle()
+    else:
+        logger.info(f"Bot started. Polling interval: {CHECK_INTERVAL}s")
+        while True:
+            check_mail()
+            logger.info("Cycle complete. Waiting...")
+            time.sleep(CHECK_INTERVAL)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import main
+from main import clean_html_content
+
+XHTML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml">'
+    "<head><title>Newsletter</title></head>"
+    "<body><p>Service &amp; suspended &#1054;&#1087;&#1083;&#1072;&#1090;&#1080;&#1090;&#1077;</p></body></html>"
+)
+
+
+def test_xml_declaration_is_parsed():
+    assert clean_html_content(XHTML) == "Service & suspended Оплатите"
+
+
+def test_regex_fallback_decodes_entities(monkeypatch):
+    def refuse(_):
+        raise ValueError("unparsable")
+
+    monkeypatch.setattr(main.lxml_html, "fromstring", refuse)
+    assert clean_html_content(XHTML) == "Service & suspended Оплатите"
+
+
+def test_empty_input():
+    assert clean_html_content("  \n") == ""
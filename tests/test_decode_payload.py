@@ -0,0 +1,27 @@
+import pytest
+
+from main import decode_payload
+
+SAMPLES = [
+    "Оплатите счёт",
+    "Задолженность по договору",
+    "Пора пополнить баланс",
+    "Услуга приостановлена до оплаты",
+    "Срок действия истекает",
+    "Требуется оплата",
+    "Доступ заблокирован",
+]
+
+
+@pytest.mark.parametrize("encoding", ["cp1251", "koi8_r"])
+@pytest.mark.parametrize("text", SAMPLES)
+def test_untagged_cyrillic_is_sniffed(text, encoding):
+    assert decode_payload(text.encode(encoding), None) == text
+
+
+def test_declared_charset_wins():
+    assert decode_payload("Оплатите счёт".encode("koi8_r"), "koi8-r") == "Оплатите счёт"
+
+
+def test_utf8_is_tried_first():
+    assert decode_payload("Оплатите счёт".encode("utf-8"), None) == "Оплатите счёт"
@@ -0,0 +1,96 @@
+import imaplib
+
+import pytest
+
+from main import fetch_parts, search_new_uids
+
+
+class CannedIMAP:
+    """ Returns queued (status, data) pairs for uid() calls and records the arguments """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def uid(self, command, *args):
+        self.calls.append((command, args))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_fetch_uid_before_literal():
+    mail = CannedIMAP(("OK", [
+        (b"1 (UID 10 BODY[] {3}", b"one"), b")",
+        (b"2 (UID 11 BODY[] {3}", b"two"), b")",
+    ]))
+    assert fetch_parts(mail, [b"10", b"11"], "BODY.PEEK[]") == {b"10": b"one", b"11": b"two"}
+    assert mail.calls == [("FETCH", (b"10,11", "(BODY.PEEK[])"))]
+
+
+def test_fetch_uid_after_literal():
+    mail = CannedIMAP(("OK", [
+        (b"1 (BODY[] {3}", b"one"), b" UID 10)",
+        (b"2 (BODY[] {3}", b"two"), b" UID 11)",
+    ]))
+    assert fetch_parts(mail, [b"10", b"11"], "BODY.PEEK[]") == {b"10": b"one", b"11": b"two"}
+
+
+def test_fetch_missing_uid_raises():
+    mail = CannedIMAP(("OK", [(b"1 (UID 10 BODY[] {3}", b"one"), b")"]))
+    with pytest.raises(imaplib.IMAP4.error, match="11"):
+        fetch_parts(mail, [b"10", b"11"], "BODY.PEEK[]")
+
+
+def test_fetch_non_ok_status_raises():
+    mail = CannedIMAP(("NO", [b"fetch failed"]))
+    with pytest.raises(imaplib.IMAP4.error):
+        fetch_parts(mail, [b"10"], "BODY.PEEK[]")
+
+
+def test_fetch_nothing_requested():
+    mail = CannedIMAP()
+    assert fetch_parts(mail, [], "BODY.PEEK[]") == {}
+    assert mail.calls == []
+
+
+def test_search_first_run_uses_since():
+    mail = CannedIMAP(("OK", [b"3 4"]))
+    assert search_new_uids(mail, {}, 7, "01-Jan-2025", []) == [b"3", b"4"]
+    assert mail.calls == [("SEARCH", (None, "SINCE", "01-Jan-2025"))]
+
+
+def test_search_incremental_drops_star_match_below_last_uid():
+    # "n:*" always matches the highest UID, even when it is below n
+    mail = CannedIMAP(("OK", [b"12"]))
+    assert search_new_uids(mail, {"uidvalidity": 7, "last_uid": 12}, 7, "01-Jan-2025", []) == []
+    assert mail.calls == [("SEARCH", (None, "UID", "13:*"))]
+
+
+def test_search_incremental_returns_new_uids():
+    mail = CannedIMAP(("OK", [b"13 14"]))
+    assert search_new_uids(mail, {"uidvalidity": 7, "last_uid": 12}, 7, "01-Jan-2025", []) == [b"13", b"14"]
+
+
+def test_search_uidvalidity_change_rescans_since():
+    mail = CannedIMAP(("OK", [b"1 2"]))
+    assert search_new_uids(mail, {"uidvalidity": 6, "last_uid": 12}, 7, "01-Jan-2025", []) == [b"1", b"2"]
+    assert mail.calls[0][1][1] == "SINCE"
+
+
+def test_search_from_criteria_and_fallback():
+    mail = CannedIMAP(imaplib.IMAP4.error("BAD"), ("OK", [b"5"]))
+    assert search_new_uids(mail, {}, 7, "01-Jan-2025", ["a@x.com", "b@y.com"]) == [b"5"]
+    assert mail.calls[0][1][3:] == ("OR", "FROM", '"a@x.com"', "FROM", '"b@y.com"')
+    assert mail.calls[1][1] == (None, "SINCE", "01-Jan-2025")
+
+
+def test_search_non_ascii_sender_searches_without_from():
+    mail = CannedIMAP(("OK", [b"5"]))
+    assert search_new_uids(mail, {}, 7, "01-Jan-2025", ["счет@банк.рф"]) == [b"5"]
+    assert mail.calls == [("SEARCH", (None, "SINCE", "01-Jan-2025"))]
+
+
+def test_search_empty_result():
+    mail = CannedIMAP(("OK", [None]))
+    assert search_new_uids(mail, {}, 7, "01-Jan-2025", []) == []